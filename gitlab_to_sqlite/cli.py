@@ -4,9 +4,11 @@ import pathlib
 import textwrap
 import os
 import sqlite_utils
+import sqlite3
 import time
 import json
 from gitlab_to_sqlite import utils
+from gitlab_to_sqlite.tokens import TokenPool
 
 
 @click.group()
@@ -32,7 +34,12 @@ def cli():
     default="gitlab.com",
     help="",
 )
-def auth(auth, host):
+@click.option(
+    "--add",
+    is_flag=True,
+    help="Add the token to the pool of tokens instead of replacing the main one",
+)
+def auth(auth, host, add):
     "Save authentication credentials to a JSON file"
     click.echo("Create a GitLab personal user token and paste it here:")
     click.echo()
@@ -41,8 +48,14 @@ def auth(auth, host):
         auth_data = json.load(auth.open())
     else:
         auth_data = {}
-    auth_data["gitlab_personal_token"] = personal_token
-    auth_data["gitlab_host"] = host
+    if add:
+        auth_data.setdefault("gitlab_tokens", []).append(
+            {"token": personal_token, "host": host}
+        )
+        auth_data.setdefault("gitlab_host", host)
+    else:
+        auth_data["gitlab_personal_token"] = personal_token
+        auth_data["gitlab_host"] = host
     with auth.open("w") as f:
         json.dump(auth_data, f, indent=4)
         f.write("\n")
@@ -54,7 +67,7 @@ def auth(auth, host):
     type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
     required=True,
 )
-@click.argument("project", required=True)
+@click.argument("project", nargs=-1, required=True)
 @click.option(
     "-a",
     "--auth",
@@ -62,13 +75,19 @@ def auth(auth, host):
     default="auth.json",
     help="Path to auth.json token file",
 )
-def projects(db_path, project, auth):
+@click.option(
+    "--batch-size",
+    type=int,
+    default=10,
+    help="Number of projects to combine into a single GraphQL request",
+)
+def projects(db_path, project, auth, batch_size):
     "Save projects"
     db = sqlite_utils.Database(db_path)
     token, host = load_config(auth)
-    project = utils.fetch_project(project, token, host)
-    utils.save_project(db, project)
-    utils.ensure_db_shape(db)
+    for data in utils.fetch_projects(project, token, host, batch_size):
+        utils.save_project(db, data)
+    ensure_db_shape(db)
 
 
 @cli.command(name="merge-requests")
@@ -104,7 +123,7 @@ def merge_requests(db_path, project, auth, full):
         utils.save_merge_request(db, merge_request)
         new += 1
 
-    utils.ensure_db_shape(db)
+    ensure_db_shape(db)
     click.echo(f"Saved/updated {new} merge requests")
 
 
@@ -114,7 +133,7 @@ def merge_requests(db_path, project, auth, full):
     type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
     required=True,
 )
-@click.argument("project", required=True)
+@click.argument("project", nargs=-1, required=True)
 @click.option(
     "-a",
     "--auth",
@@ -126,22 +145,61 @@ def merge_requests(db_path, project, auth, full):
     "--full",
     is_flag=True,
 )
-def pipelines(db_path, project, auth, full):
+@click.option(
+    "--batch-size",
+    type=int,
+    default=10,
+    help="Number of projects to combine into a single GraphQL request",
+)
+@click.option(
+    "--partition-by",
+    type=click.Choice(utils.PARTITION_BY),
+    help="Write rows into separate databases per month, year or project",
+)
+def pipelines(db_path, project, auth, full, batch_size, partition_by):
     "Save pipelines"
     db = sqlite_utils.Database(db_path)
     token, host = load_config(auth)
+    partition_by = get_partition_by(db, partition_by)
+    partitions = utils.open_partitions(db)
+    written = {}
 
     new = 0
-    for pipeline in utils.fetch_pipelines(
-        project,
+    synced = {}
+    for pipeline in utils.fetch_projects_pipelines(
+        {
+            p: None if full else utils.get_latest_pipeline_time(db, p, partitions)
+            for p in project
+        },
         token,
         host,
-        None if full else utils.get_latest_pipeline_time(db, project),
+        batch_size,
     ):
-        utils.save_pipeline(db, pipeline, host)
+        project_id = pipeline["project"]["id"].split("/")[-1]
+        synced[project_id] = max(
+            filter(
+                None,
+                [synced.get(project_id), pipeline["createdAt"], pipeline["updatedAt"]],
+            )
+        )
+        target = utils.get_partition(
+            db,
+            written,
+            partition_by,
+            pipeline["createdAt"],
+            project_id,
+            "pipelines",
+            pipeline["id"].split("/")[-1],
+        )
+        if target is None:
+            continue
+        utils.save_pipeline(target, pipeline, host)
         new += 1
 
-    utils.ensure_db_shape(db)
+    utils.set_sync_times(db, "pipelines", synced)
+    ensure_db_shape(db)
+    for partition in filter(None, written.values()):
+        ensure_db_shape(partition)
     click.echo(f"Saved/updated {new} pipelines")
 
 
@@ -151,7 +209,7 @@ def pipelines(db_path, project, auth, full):
     type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
     required=True,
 )
-@click.argument("project", required=True)
+@click.argument("project", nargs=-1, required=True)
 @click.option(
     "-a",
     "--auth",
@@ -159,20 +217,27 @@ def pipelines(db_path, project, auth, full):
     default="auth.json",
     help="Path to auth.json token file",
 )
-def environments(db_path, project, auth):
+@click.option(
+    "--batch-size",
+    type=int,
+    default=10,
+    help="Number of projects to combine into a single GraphQL request",
+)
+def environments(db_path, project, auth, batch_size):
     db = sqlite_utils.Database(db_path)
     token, host = load_config(auth)
 
     new = 0
-    for environment in utils.fetch_environments(
+    for environment in utils.fetch_projects_environments(
         project,
         token,
         host,
+        batch_size,
     ):
         utils.save_environment(db, environment)
         new += 1
 
-    utils.ensure_db_shape(db)
+    ensure_db_shape(db)
     click.echo(f"Saved/updated {new} environments")
 
 
@@ -183,7 +248,7 @@ def environments(db_path, project, auth):
     required=True,
 )
 @click.argument("project", required=True)
-@click.argument("environment", required=True)
+@click.argument("environment", required=False)
 @click.option(
     "-a",
     "--auth",
@@ -191,45 +256,62 @@ def environments(db_path, project, auth):
     default="auth.json",
     help="Path to auth.json token file",
 )
-def deployments(db_path, project, environment, auth):
+@click.option(
+    "--workers",
+    type=int,
+    default=8,
+    help="Number of environments to fetch concurrently when no environment is given",
+)
+@click.option(
+    "--partition-by",
+    type=click.Choice(utils.PARTITION_BY),
+    help="Write rows into separate databases per month, year or project",
+)
+def deployments(db_path, project, environment, auth, workers, partition_by):
     db = sqlite_utils.Database(db_path)
     token, host = load_config(auth)
+    partition_by = get_partition_by(db, partition_by)
+    partitions = utils.open_partitions(db)
+    written = {}
 
-    if (
-        "deployments" in db.table_names()
-        and "projects" in db.table_names()
-        and "environments" in db.table_names()
-    ):
-        r = db.query(
-            """
-        SELECT
-            max(d.updated_at) AS last_update
-        FROM
-            deployments d
-            JOIN projects p ON d.project_id = p.id
-            JOIN environments e ON d.environment_id = e.id
-        WHERE
-            p.full_path = ?
-            AND e.name = ?
-        """,
-            [project, environment],
+    if environment is None:
+        last_updated = utils.get_latest_deployment_times(db, project, partitions)
+        if not last_updated:
+            # Nothing known about this project yet, fetch all environments
+            # and their complete deployment history.
+            for env in utils.fetch_environments(project, token, host):
+                utils.save_environment(db, env)
+                last_updated[env["name"]] = None
+        deployments = utils.fetch_all_deployments(
+            project, last_updated, token, host, workers
         )
-        last_update = next(r)["last_update"]
     else:
-        last_update = None
+        last_update = utils.get_latest_deployment_times(db, project, partitions).get(
+            environment
+        )
+        deployments = utils.fetch_deployments(
+            project,
+            environment,
+            token,
+            host,
+            last_update,
+        )
 
     new = 0
-    for deployment in utils.fetch_deployments(
-        project,
-        environment,
-        token,
-        host,
-        last_update,
-    ):
-        if utils.save_deployment(db, deployment) is not False:
-            new += 1
+    synced = {}
+    for batch in utils.batched(deployments, 100):
+        new += utils.save_deployments_partitioned(db, batch, partition_by, written)
+        for deployment in batch:
+            environment_id = deployment["environment"]["id"]
+            synced[environment_id] = max(
+                filter(None, [synced.get(environment_id), deployment["updated_at"]])
+            )
 
-    utils.ensure_db_shape(db)
+    utils.set_sync_times(db, "deployments", synced)
+
+    ensure_db_shape(db)
+    for partition in filter(None, written.values()):
+        ensure_db_shape(partition)
     click.echo(f"Saved/updated {new} deployments")
 
 
@@ -260,22 +342,185 @@ def commits(db_path, project, auth):
         utils.save_commit(db, commit)
         new += 1
 
-    utils.ensure_db_shape(db)
+    ensure_db_shape(db)
     click.echo(f"Saved/updated {new} commits")
 
 
+@cli.command(name="prune")
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.option(
+    "-r",
+    "--retention",
+    "retention",
+    multiple=True,
+    help="Days to keep rows of a table for, e.g. jobs=30. Defaults to "
+    + ", ".join(f"{table}={days}" for table, days in utils.RETENTION_DAYS.items()),
+)
+@click.option(
+    "--summarize",
+    is_flag=True,
+    help="Add pruned rows to daily summary tables before deleting them",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=1000,
+    help="Number of rows to delete per transaction",
+)
+@click.option(
+    "--vacuum",
+    is_flag=True,
+    help="Switch the database to incremental vacuum if necessary (runs VACUUM once)",
+)
+def prune(db_path, retention, summarize, batch_size, vacuum):
+    "Delete old pipelines, jobs and deployments"
+    db = sqlite_utils.Database(db_path)
+
+    days = dict(utils.RETENTION_DAYS)
+    for item in retention:
+        table, _, value = item.partition("=")
+        if table not in utils.SUMMARIES or not value.isdigit():
+            raise click.BadParameter(
+                f"expected TABLE=DAYS with TABLE one of {', '.join(utils.SUMMARIES)}",
+                param_hint="--retention",
+            )
+        days[table] = int(value)
+
+    if vacuum and db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        utils.enable_incremental_vacuum(db)
+
+    schemas = {"main": db_path}
+    schemas.update(utils.get_partition_paths(db))
+    for name, path in schemas.items():
+        if name == "main":
+            schema = "main"
+        elif not path.exists():
+            # Archived, attaching it would create an empty file.
+            continue
+        elif not os.access(path, os.W_OK):
+            click.echo(f"Skipping read-only partition {path}")
+            continue
+        else:
+            schema = "partition"
+            db.execute("ATTACH DATABASE ? AS [partition]", [str(path)])
+            if vacuum and db.execute("PRAGMA partition.auto_vacuum").fetchone()[0] != 2:
+                db.execute("PRAGMA partition.auto_vacuum = INCREMENTAL")
+                db.execute("VACUUM partition")
+
+        for table, keep in days.items():
+            deleted = utils.prune_table(db, table, keep, summarize, batch_size, schema)
+            if deleted:
+                click.echo(f"Deleted {deleted} {table} from {path}")
+
+        if (
+            not utils.reclaim_space(db, schema)
+            and db.execute(f"PRAGMA [{schema}].freelist_count").fetchone()[0]
+        ):
+            click.echo(
+                f"Freed pages in {path} are kept for reuse, run with --vacuum to "
+                "return them to the file system"
+            )
+        if schema != "main":
+            db.execute("DETACH DATABASE [partition]")
+
+    for table, deleted in utils.prune_placeholders(db, batch_size).items():
+        if deleted:
+            click.echo(f"Deleted {deleted} placeholder {table}")
+    utils.reclaim_space(db)
+
+    ensure_db_shape(db)
+
+
+@cli.command(name="query")
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument("sql", required=True)
+@click.option(
+    "--since",
+    help="Only include month or year partitions from this one on, e.g. 2024-05",
+)
+@click.option(
+    "--partition",
+    "selected",
+    multiple=True,
+    help="Only include this partition, can be used several times",
+)
+def query(db_path, sql, since, selected):
+    "Run a read-only SQL query, including tables split into partitions"
+    conn = sqlite3.connect(
+        f"{pathlib.Path(db_path).resolve().as_uri()}?mode=ro", uri=True
+    )
+    db = sqlite_utils.Database(conn)
+
+    names = list(utils.get_partition_paths(db))
+    if selected:
+        unknown = set(selected) - set(names)
+        if unknown:
+            raise click.BadParameter(
+                f"unknown partitions {', '.join(sorted(unknown))}",
+                param_hint="--partition",
+            )
+        names = list(selected)
+    if since:
+        if utils.get_meta(db, "partition_by") == "project":
+            raise click.BadParameter(
+                "database is partitioned by project", param_hint="--since"
+            )
+        # Year partitions are compared with the year of `since` only.
+        names = [name for name in names if name >= since[: len(name)]]
+
+    try:
+        utils.attach_partitions(db, read_only=True, names=names)
+    except ValueError as e:
+        raise click.ClickException(
+            f"{e}, select fewer partitions with --since or --partition"
+        )
+    for row in db.query(sql):
+        click.echo(json.dumps(row, default=str))
+
+
+def ensure_db_shape(db):
+    for name, stat in utils.ensure_db_shape(db).items():
+        click.echo(f"Created index {name}, ANALYZE statistics: {stat or 'no rows'}")
+
+
+def get_partition_by(db, partition_by):
+    current = utils.get_meta(db, "partition_by")
+    if partition_by is None or partition_by == current:
+        return current
+    if current is not None:
+        raise click.ClickException(f"Database is already partitioned by {current}")
+    utils.set_meta(db, "partition_by", partition_by)
+    return partition_by
+
+
 def load_config(auth):
     try:
         data = json.load(open(auth))
-        token = data["gitlab_personal_token"]
-        host = data["gitlab_host"]
-    except (KeyError, FileNotFoundError):
-        token = None
-        host = None
-    if token is None:
-        # Fallback to GITLAB_TOKEN environment variable
-        token = os.environ.get("GITLAB_TOKEN")
+    except FileNotFoundError:
+        data = {}
+    host = data.get("gitlab_host")
     if host is None:
         # Fallback to GITLAB_HOST environment variable
-        token = os.environ.get("GITLAB_HOST")
-    return token, host
+        host = os.environ.get("GITLAB_HOST")
+
+    tokens = []
+    if data.get("gitlab_personal_token"):
+        tokens.append(data["gitlab_personal_token"])
+    # Additional tokens, possibly for other hosts, only those for the host in
+    # use are part of the pool.
+    for entry in data.get("gitlab_tokens", []):
+        if entry.get("host", data.get("gitlab_host")) == host:
+            tokens.append(entry["token"])
+    if not tokens and os.environ.get("GITLAB_TOKEN"):
+        # Fallback to GITLAB_TOKEN environment variable
+        tokens.append(os.environ["GITLAB_TOKEN"])
+
+    return TokenPool(tokens) if tokens else None, host
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+from typing import TYPE_CHECKING, Mapping
+
+if TYPE_CHECKING:
+    import requests
+
+
+class TokenPool:
+    """Spreads requests across several personal access tokens of one host.
+
+    Every request asks the pool for a token and reports the response back.
+    The pool prefers the token with the largest remaining rate limit budget
+    (from GitLab's RateLimit-Remaining header), tokens without known budget
+    are used round robin. Throttled tokens are skipped until their limit
+    resets, tokens rejected with 401 are not used anymore.
+    """
+
+    def __init__(self, tokens: list[str]):
+        if not tokens:
+            raise ValueError("TokenPool needs at least one token")
+        self.lock = threading.Lock()
+        self.tokens = {
+            token: {"remaining": None, "throttled_until": 0.0, "last_used": 0.0}
+            for token in dict.fromkeys(tokens)
+        }
+
+    @classmethod
+    def of(cls, token: str | TokenPool) -> TokenPool:
+        return token if isinstance(token, TokenPool) else cls([token])
+
+    def acquire(self) -> str:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if not self.tokens:
+                    raise RuntimeError("All GitLab tokens have been rejected")
+                ready = [
+                    token
+                    for token, state in self.tokens.items()
+                    if state["throttled_until"] <= now
+                ]
+                if ready:
+                    token = max(
+                        ready,
+                        key=lambda token: (
+                            self._remaining(token),
+                            -self.tokens[token]["last_used"],
+                        ),
+                    )
+                    state = self.tokens[token]
+                    state["last_used"] = now
+                    if state["remaining"] is not None:
+                        state["remaining"] -= 1
+                    return token
+                wait = min(s["throttled_until"] for s in self.tokens.values()) - now
+            time.sleep(wait)
+
+    def update(self, token: str, status: int, headers: Mapping[str, str]) -> None:
+        with self.lock:
+            if token not in self.tokens:
+                return
+            if status == 401:
+                del self.tokens[token]
+                return
+
+            state = self.tokens[token]
+            if headers.get("RateLimit-Remaining") is not None:
+                state["remaining"] = int(headers["RateLimit-Remaining"])
+            if status == 429 or state["remaining"] == 0:
+                state["throttled_until"] = time.monotonic() + self._retry_after(headers)
+                # The budget is unknown again once the limit has been reset.
+                state["remaining"] = None
+
+    def session(self) -> requests.Session:
+        """A requests session for python-gitlab that uses the tokens of the pool."""
+        import requests
+
+        pool = self
+
+        class PooledSession(requests.Session):
+            def request(self, method, url, *args, **kwargs):
+                while True:
+                    token = pool.acquire()
+
+                    def auth(request):
+                        request.headers["PRIVATE-TOKEN"] = token
+                        return request
+
+                    kwargs["auth"] = auth
+                    response = super().request(method, url, *args, **kwargs)
+                    pool.update(token, response.status_code, response.headers)
+                    if response.status_code not in (401, 429):
+                        return response
+
+        return PooledSession()
+
+    def _remaining(self, token: str) -> float:
+        remaining = self.tokens[token]["remaining"]
+        return math.inf if remaining is None else remaining
+
+    @staticmethod
+    def _retry_after(headers: Mapping[str, str]) -> float:
+        try:
+            return float(headers["Retry-After"])
+        except (KeyError, ValueError):
+            pass
+        if headers.get("RateLimit-Reset") is not None:
+            return max(float(headers["RateLimit-Reset"]) - time.time(), 1.0)
+        return 60.0
@@ -1,21 +1,60 @@
+from __future__ import annotations
+
+import concurrent.futures
 import datetime
-import gitlab
-from graphql import DocumentNode
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
+import functools
+import json
+import logging
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+from typing import TYPE_CHECKING
 from sqlite_utils import Database
+from gitlab_to_sqlite.tokens import TokenPool
+
+# gitlab, gql and the aiohttp transport take several hundred milliseconds to
+# import, so they are only loaded once a command actually talks to GitLab.
+if TYPE_CHECKING:
+    import gitlab
+    from graphql import DocumentNode
+    from gql import Client
+
+logger = logging.getLogger(__name__)
+
+
+@functools.cache
+def parse_query(query: str) -> DocumentNode:
+    from gql import gql
+
+    return gql(query)
+
 
+def get_client(host: str, token: str | TokenPool) -> Client:
+    from gql import Client
+    from gql.transport.aiohttp import AIOHTTPTransport
 
-def get_client(host: str, token: str) -> Client:
-    transport = AIOHTTPTransport(
-        url=f"https://{host}/api/graphql",
-        headers={"Authorization": f"Bearer {token}"},
+    # Every query picks its own token from the pool, see `execute`. The schema
+    # isn't fetched, that request couldn't report a rejected token to the pool.
+    transport = AIOHTTPTransport(url=f"https://{host}/api/graphql")
+    client = Client(
+        transport=transport, fetch_schema_from_transport=False, execute_timeout=20
     )
-    return Client(transport=transport, fetch_schema_from_transport=True, execute_timeout=20)
+    client.token_pool = TokenPool.of(token)
+    return client
 
 
-project_query = gql(
-    """
+def get_gitlab(host: str, token: str | TokenPool) -> gitlab.Gitlab:
+    import gitlab
+
+    pool = TokenPool.of(token)
+    return gitlab.Gitlab(
+        url=f"https://{host}", private_token=pool.acquire(), session=pool.session()
+    )
+
+
+project_query = """
 query project ($project: ID!) {
   project(fullPath: $project) {
     id
@@ -28,14 +67,21 @@ query project ($project: ID!) {
   }
 }
 """
-)
 
 
-def fetch_project(project: str, token: str, host: str) -> dict:
+def fetch_project(project: str, token: str | TokenPool, host: str) -> dict:
     client = get_client(host, token)
-    return client.execute(project_query, variable_values={"project": project})[
-        "project"
-    ]
+    return execute(client, parse_query(project_query), {"project": project})["project"]
+
+
+def fetch_projects(
+    projects: list[str], token: str | TokenPool, host: str, batch_size: int = 10
+) -> list[dict]:
+    client = get_client(host, token)
+    for _, project in execute_batched(
+        client, project_query, {project: {} for project in projects}, batch_size
+    ):
+        yield project
 
 
 def save_project(db: Database, project: dict) -> None:
@@ -62,8 +108,7 @@ def save_project(db: Database, project: dict) -> None:
     )
 
 
-pipelines_query = gql(
-    """
+pipelines_query = """
 query pipelines ($project: ID!, $after: String, $updated_after: Time) {
   project(fullPath: $project) {
     pipelines(first: 100, after: $after, updatedAfter: $updated_after) {
@@ -111,11 +156,13 @@ query pipelines ($project: ID!, $after: String, $updated_after: Time) {
   }
 }
   """
-)
 
 
 def fetch_pipelines(
-    project: str, token: str, host: str, updated_or_created_after: str | None
+    project: str,
+    token: str | TokenPool,
+    host: str,
+    updated_or_created_after: str | None,
 ) -> list[dict]:
     client = get_client(host, token)
     yield from paginate(
@@ -127,6 +174,27 @@ def fetch_pipelines(
     )
 
 
+def fetch_projects_pipelines(
+    projects: dict[str, str | None],
+    token: str | TokenPool,
+    host: str,
+    batch_size: int = 10,
+) -> list[dict]:
+    """Fetch pipelines of several projects, see `fetch_pipelines`.
+
+    `projects` maps full paths to the time of their most recent pipeline.
+    """
+    client = get_client(host, token)
+    for _, pipeline in paginate_batched(
+        client,
+        pipelines_query,
+        "pipelines",
+        {project: {"updated_after": after} for project, after in projects.items()},
+        batch_size,
+    ):
+        yield pipeline
+
+
 def save_pipeline(db: Database, pipeline: dict, host: str) -> None:
     if "projects" not in db.table_names():
         db["projects"].create({"id": int}, pk="id")
@@ -216,7 +284,9 @@ def save_pipeline(db: Database, pipeline: dict, host: str) -> None:
         )
 
 
-def get_latest_pipeline_time(db: Database, project: str) -> str | None:
+def get_latest_pipeline_time(
+    db: Database, project: str, partitions: dict[str, Database] | None = None
+) -> str | None:
     result = db.query(
         """
         select id from projects where full_path = ?""",
@@ -224,26 +294,37 @@ def get_latest_pipeline_time(db: Database, project: str) -> str | None:
     )
     project_id = next(result)["id"]
 
-    if db["pipelines"].exists():
-        result = db.query(
+    # Rows are still considered for databases synced before the sync time
+    # was stored.
+    latest = get_sync_time(db, "pipelines", project_id)
+    for source in [db, *(partitions or {}).values()]:
+        if not source["pipelines"].exists():
+            continue
+        # Separate subqueries so that each max() can be answered from its index.
+        result = source.query(
             """
-            select max(created_at) as created, max(updated_at) as updated from pipelines where project_id = ?""",
-            [project_id],
+            select
+                (select max(created_at) from pipelines where project_id = :id) as created,
+                (select max(updated_at) from pipelines where project_id = :id) as updated""",
+            {"id": project_id},
         )
         row = next(result)
         if row["created"] and row["updated"]:
-            return max(row["created"], row["updated"])
+            latest = max(filter(None, [latest, row["created"], row["updated"]]))
 
-    return None
+    return latest
 
 
-environments_query = gql(
-    """
-query environments ($project: ID!) {
+environments_query = """
+query environments ($project: ID!, $after: String) {
   project(fullPath: $project) {
     id
 
-    environments {
+    environments(first: 100, after: $after) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
       nodes {
         id
         name
@@ -260,14 +341,42 @@ query environments ($project: ID!) {
   }
 }
   """
-)
 
 
-def fetch_environments(project: str, token: str, host: str) -> list[dict]:
+def fetch_environments(project: str, token: str | TokenPool, host: str) -> list[dict]:
+    yield from fetch_projects_environments([project], token, host, batch_size=1)
+
+
+def fetch_projects_environments(
+    projects: list[str], token: str | TokenPool, host: str, batch_size: int = 10
+) -> list[dict]:
     client = get_client(host, token)
-    result = client.execute(environments_query, variable_values={"project": project})
-    for environment in result["project"]["environments"]["nodes"]:
-        environment["project_id"] = result["project"]["id"].split("/")[-1]
+    for project, result in execute_batched(
+        client, environments_query, {project: {} for project in projects}, batch_size
+    ):
+        project_id = result["id"].split("/")[-1]
+        environments = result["environments"]
+        yield from project_environments(project_id, environments["nodes"], host)
+
+        if environments["pageInfo"]["hasNextPage"]:
+            yield from project_environments(
+                project_id,
+                paginate(
+                    client,
+                    environments_query,
+                    "environments",
+                    after=environments["pageInfo"]["endCursor"],
+                    project=project,
+                ),
+                host,
+            )
+
+
+def project_environments(
+    project_id: str, environments: list[dict], host: str
+) -> list[dict]:
+    for environment in environments:
+        environment["project_id"] = project_id
         environment["web_url"] = f"https://{host}{environment['path']}"
         del environment["path"]
         yield environment
@@ -311,8 +420,8 @@ def save_environment(db: Database, environment: dict) -> None:
     )
 
 
-def fetch_commits(project: str, token: str, host: str) -> list[dict]:
-    gl = gitlab.Gitlab(url=f"https://{host}", private_token=token)
+def fetch_commits(project: str, token: str | TokenPool, host: str) -> list[dict]:
+    gl = get_gitlab(host, token)
 
     project = gl.projects.get(id=project)
     return project.commits.list(iterator=True, with_stats=True)
@@ -354,9 +463,15 @@ def save_commit(db: Database, commit) -> None:
 
 
 def fetch_deployments(
-    project: str, name: str, token: str, host: str, last_updated: str | None
+    project: str,
+    name: str,
+    token: str | TokenPool,
+    host: str,
+    last_updated: str | None,
+    gl: gitlab.Gitlab | None = None,
 ) -> list[dict]:
-    gl = gitlab.Gitlab(url=f"https://{host}", private_token=token)
+    if gl is None:
+        gl = get_gitlab(host, token)
 
     project = gl.projects.get(id=project, lazy=True)
     for deployment in project.deployments.list(
@@ -369,38 +484,162 @@ def fetch_deployments(
         yield deployment.asdict()
 
 
+def fetch_all_deployments(
+    project: str,
+    last_updated: dict[str, str | None],
+    token: str | TokenPool,
+    host: str,
+    workers: int = 8,
+    buffer_size: int = 1000,
+) -> list[dict]:
+    """Fetch deployments of several environments concurrently.
+
+    `last_updated` maps environment names to the time of their most recent
+    known deployment. Worker threads hand deployments to the calling thread
+    through a queue of at most `buffer_size` items, so they are yielded as
+    soon as they arrive instead of after an environment has been fetched
+    completely.
+    """
+    gl = get_gitlab(host, token)
+    results = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up once the consumer went away, otherwise a full queue would
+        # block the worker (and the executor shutdown) forever.
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(name, since):
+        if stop.is_set():
+            return
+        try:
+            for deployment in fetch_deployments(
+                project, name, token, host, since, gl=gl
+            ):
+                if not put(deployment):
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(done)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, since in last_updated.items():
+            executor.submit(fetch, name, since)
+        try:
+            pending = len(last_updated)
+            while pending:
+                item = results.get()
+                if item is done:
+                    pending -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            executor.shutdown(cancel_futures=True)
+
+
+def get_latest_deployment_times(
+    db: Database, project: str, partitions: dict[str, Database] | None = None
+) -> dict[str, str | None]:
+    """Most recent deployment update per known environment of a project."""
+    if not {"projects", "environments"}.issubset(db.table_names()):
+        return {}
+    # save_deployment creates environments as placeholders with only an id.
+    if not {"name", "project_id"}.issubset(db["environments"].columns_dict):
+        return {}
+
+    environments = db.query(
+        """
+        SELECT e.id, e.name
+        FROM environments e JOIN projects p ON e.project_id = p.id
+        WHERE p.full_path = ? AND e.name IS NOT NULL
+        """,
+        [project],
+    )
+    last_updated = {}
+    for environment in environments:
+        latest = get_sync_time(db, "deployments", environment["id"])
+        for source in [db, *(partitions or {}).values()]:
+            if not source["deployments"].exists():
+                continue
+            result = source.query(
+                "SELECT max(updated_at) AS last_update FROM deployments WHERE environment_id = ?",
+                [environment["id"]],
+            )
+            latest = max(
+                filter(None, [latest, next(result)["last_update"]]), default=None
+            )
+        last_updated[environment["name"]] = latest
+    return last_updated
+
+
 def save_deployment(db: Database, deployment) -> None:
+    if not save_deployments(db, [deployment]):
+        return False
+
+
+def save_deployments(
+    db: Database, deployments: list, main: Database | None = None
+) -> int:
+    """Save a batch of deployments, returns the number of saved rows.
+
+    `main` is the database holding projects and environments if `db` is a
+    partition, see `get_partition`.
+    """
     if "projects" not in db.table_names():
         db["projects"].create({"id": int}, pk="id")
     if "environments" not in db.table_names():
         db["environments"].create({"id": int}, pk="id")
     if "jobs" not in db.table_names():
         db["jobs"].create({"id": int}, pk="id")
+    if "commits" not in db.table_names():
+        db["commits"].create({"id": str}, pk="id")
+
+    rows = []
+    for deployment in deployments:
+        if not deployment["deployable"]:
+            continue
+
+        rows.append(
+            {
+                "id": deployment["id"],
+                "created_at": deployment["created_at"],
+                "updated_at": deployment["updated_at"],
+                "status": deployment["status"],
+                "ref": deployment["ref"],
+                "commit_sha": deployment["sha"],
+                "job_id": deployment["deployable"]["id"],
+                "project_id": deployment["deployable"]["pipeline"]["project_id"],
+                "environment_id": deployment["environment"]["id"],
+            }
+        )
 
-    if not deployment["deployable"]:
-        return False
-
-    project_id = deployment["deployable"]["pipeline"]["project_id"]
-    environment_id = deployment["environment"]["id"]
-
-    db["projects"].upsert({"id": project_id}, pk="id")
-    db["environments"].upsert({"id": environment_id}, pk="id")
-    db["jobs"].upsert({"id": deployment["deployable"]["id"]}, pk="id")
-
-    data = {
-        "id": deployment["id"],
-        "created_at": deployment["created_at"],
-        "updated_at": deployment["updated_at"],
-        "status": deployment["status"],
-        "ref": deployment["ref"],
-        "commit_sha": deployment["sha"],
-        "job_id": deployment["deployable"]["id"],
-        "project_id": project_id,
-        "environment_id": environment_id,
-    }
+    if not rows:
+        return 0
+
+    placeholders = [("projects", "project_id"), ("environments", "environment_id")]
+    if main is None:
+        main = db
+        placeholders.append(("jobs", "job_id"))
+    # Placeholder jobs are skipped for partitions, the jobs view would show them
+    # in addition to the actual job living in another partition.
+    for table, column in placeholders:
+        main[table].upsert_all(
+            [{"id": id} for id in {row[column] for row in rows}], pk="id"
+        )
 
-    db["deployments"].insert(
-        data,
+    db["deployments"].insert_all(
+        rows,
         pk="id",
         alter=True,
         replace=True,
@@ -422,10 +661,52 @@ def save_deployment(db: Database, deployment) -> None:
             ("commit_sha", "commits", "id"),
         ],
     )
+    return len(rows)
+
+
+def save_deployments_partitioned(
+    db: Database,
+    deployments: list,
+    partition_by: str | None,
+    partitions: dict[str, Database],
+) -> int:
+    if partition_by is None:
+        return save_deployments(db, deployments)
+
+    targets = {}
+    for deployment in deployments:
+        if not deployment["deployable"]:
+            continue
+        target = get_partition(
+            db,
+            partitions,
+            partition_by,
+            deployment["created_at"],
+            deployment["deployable"]["pipeline"]["project_id"],
+            "deployments",
+            deployment["id"],
+        )
+        if target is None:
+            continue
+        targets.setdefault(target, []).append(deployment)
 
+    return sum(
+        save_deployments(target, rows, main=db) for target, rows in targets.items()
+    )
 
-merge_requests_query = gql(
-    """
+
+def batched(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+merge_requests_query = """
 query merge_requests($project: ID!, $after: String, $updated_after: Time) {
   project(fullPath: $project) {
     mergeRequests(first: 100, after: $after, updatedAfter: $updated_after) {
@@ -465,11 +746,13 @@ query merge_requests($project: ID!, $after: String, $updated_after: Time) {
   }
 }
   """
-)
 
 
 def fetch_merge_requests(
-    project: str, token: str, host: str, updated_or_created_after: str | None
+    project: str,
+    token: str | TokenPool,
+    host: str,
+    updated_or_created_after: str | None,
 ) -> list[dict]:
     client = get_client(host, token)
     yield from paginate(
@@ -551,10 +834,10 @@ def get_latest_merge_request_time(db: Database, project: str) -> str | None:
     if db["merge_requests"].exists():
         result = db.query(
             """
-            SELECT MAX(created_at) AS created, MAX(updated_at) AS updated
-            FROM merge_requests
-            WHERE target_project_id = ?""",
-            [project["id"]],
+            SELECT
+                (SELECT MAX(created_at) FROM merge_requests WHERE target_project_id = :id) AS created,
+                (SELECT MAX(updated_at) FROM merge_requests WHERE target_project_id = :id) AS updated""",
+            {"id": project["id"]},
         )
         row = next(result)
         if row["created"] and row["updated"]:
@@ -563,30 +846,848 @@ def get_latest_merge_request_time(db: Database, project: str) -> str | None:
     return None
 
 
+def request_with_token(client: Client, send):
+    """Call `send` with tokens of the client's pool until it succeeds.
+
+    `send(token)` returns its result and the headers of the response. Failures
+    are retried up to four times. HTTP errors are reported to the pool first,
+    so that rejected and throttled tokens aren't used for the next attempt.
+    """
+    import requests
+    from gql.transport.exceptions import TransportServerError
+
+    attempt = 0
+    while True:
+        token = client.token_pool.acquire()
+        try:
+            result, headers = send(token)
+        except TransportServerError as e:
+            client.token_pool.update(
+                token, e.code, client.transport.response_headers or {}
+            )
+            error = e
+        except requests.HTTPError as e:
+            client.token_pool.update(token, e.response.status_code, e.response.headers)
+            error = e
+        except Exception as e:
+            error = e
+        else:
+            client.token_pool.update(token, 200, headers)
+            return result
+
+        attempt += 1
+        if attempt > 4:
+            raise error
+
+
+def execute(client: Client, document: DocumentNode, variables: dict) -> dict:
+    def send(token):
+        result = client.execute(
+            document,
+            variable_values=variables,
+            extra_args={"headers": {"Authorization": f"Bearer {token}"}},
+        )
+        return result, client.transport.response_headers or {}
+
+    return request_with_token(client, send)
+
+
 def paginate(
-    client: Client, query: DocumentNode, node: str, get=lambda r: r["project"], **args
+    client: Client,
+    query: str,
+    node: str,
+    root: str = "project",
+    after: str | None = None,
+    **args,
 ):
     has_next_page = True
-    after_cursor = None
+    after_cursor = after
     while has_next_page:
-        attempt = 0
+        page_infos = yield from map_page(
+            stream_page(client, query, [root], node, {**args, "after": after_cursor}),
+            lambda _, item: item,
+        )
+        page_info = page_infos.get(root)
+        if page_info is None:
+            raise ValueError(
+                f"Project {args.get('project')} not found or not accessible"
+            )
+
+        has_next_page = page_info["hasNextPage"]
+        after_cursor = page_info["endCursor"]
+
+
+def map_page(page, function):
+    """Apply `function` to the roots and nodes of `stream_page`.
+
+    Returns the pageInfos of `page`, which a plain generator expression
+    wouldn't.
+    """
+    while True:
+        try:
+            root, item = next(page)
+        except StopIteration as stop:
+            return stop.value
+        yield function(root, item)
+
+
+def stream_page(
+    client: Client, query: str, roots: list[str], node: str, variables: dict
+):
+    """Yield the nodes of a single page, returns the pageInfo of every root.
+
+    `roots` are the fields the paginated `node` is requested on, e.g.
+    ["project"], or ["p0", "p1"] for `batch_project_query`. Nodes are yielded
+    together with their root, the pageInfo of a root that is null (e.g. a
+    project that doesn't exist) is None.
+
+    Unlike `execute` the response is decoded while it is received, so only a
+    single node (e.g. a pipeline with all its jobs) is held in memory at a
+    time instead of the whole page.
+
+    Failed requests are retried. So is the page if the response breaks off
+    before the first node, afterwards an error is raised instead of yielding
+    the nodes a second time.
+    """
+    import ijson
+    import requests
+    import urllib3
+    from gql.transport.exceptions import TransportQueryError
+
+    nodes = {f"data.{root}.{node}.nodes.item": root for root in roots}
+    fields = {
+        f"data.{root}.{node}.pageInfo.{field}": (root, field)
+        for root in roots
+        for field in ["hasNextPage", "endCursor"]
+    }
+    nulls = {f"data.{root}": root for root in roots}
+
+    def send(token):
+        # Sent like the client's transport would, except that the response
+        # is streamed.
+        response = requests.post(
+            client.transport.url,
+            json={"query": query, "variables": variables},
+            headers={
+                **(client.transport.headers or {}),
+                "Authorization": f"Bearer {token}",
+            },
+            stream=True,
+            timeout=client.execute_timeout,
+        )
+        if response.status_code >= 400:
+            response.close()
+            response.raise_for_status()
+        return response, response.headers
+
+    attempt = 0
+    while True:
+        response = request_with_token(client, send)
+
+        page_infos = {}
+        errors = None
+        builder = None
+        yielded = 0
+        try:
+            with response:
+                response.raw.decode_content = True
+                for current, event, value in ijson.parse(response.raw, use_float=True):
+                    if builder is not None:
+                        builder.event(event, value)
+                        if (current, event) == end:
+                            if target is None:
+                                errors = builder.value
+                            else:
+                                yield target, builder.value
+                                yielded += 1
+                            builder = None
+                    elif current in nodes and event == "start_map":
+                        target, end = nodes[current], (current, "end_map")
+                        builder = ijson.ObjectBuilder()
+                        builder.event(event, value)
+                    elif current == "errors" and event == "start_array":
+                        target, end = None, (current, "end_array")
+                        builder = ijson.ObjectBuilder()
+                        builder.event(event, value)
+                    elif current in fields:
+                        root, field = fields[current]
+                        page_infos.setdefault(root, {})[field] = value
+                    elif current in nulls and event == "null":
+                        page_infos[nulls[current]] = None
+        except (
+            requests.RequestException,
+            urllib3.exceptions.HTTPError,
+            ijson.JSONError,
+        ) as e:
+            if yielded:
+                raise RuntimeError(
+                    f"Response broke off after {yielded} nodes of {node}"
+                ) from e
+            attempt += 1
+            if attempt > 4:
+                raise
+            continue
+        break
+
+    if errors:
+        raise TransportQueryError(str(errors[0]), errors=errors)
+    return page_infos
+
+
+@functools.cache
+def batch_project_query(query: str, count: int) -> str:
+    """Combine `count` copies of a single project query into one document.
+
+    The `project` field of copy `i` is aliased to `p<i>` and all of its
+    variables are renamed to `<name>_<i>`, e.g.
+
+        p0: project(fullPath: $project_0) { ... }
+        p1: project(fullPath: $project_1) { ... }
+    """
+    from graphql import (
+        DocumentNode,
+        FieldNode,
+        NameNode,
+        OperationDefinitionNode,
+        SelectionSetNode,
+        VariableNode,
+        Visitor,
+        parse,
+        print_ast,
+        visit,
+    )
+
+    operation = parse(query).definitions[0]
+
+    class RenameVariables(Visitor):
+        def __init__(self, index):
+            super().__init__()
+            self.index = index
+
+        def enter_variable(self, node, *args):
+            return VariableNode(name=NameNode(value=f"{node.name.value}_{self.index}"))
+
+    variable_definitions = []
+    selections = []
+    for index in range(count):
+        renamed = visit(operation, RenameVariables(index))
+        variable_definitions.extend(renamed.variable_definitions)
+        field = renamed.selection_set.selections[0]
+        selections.append(
+            FieldNode(
+                alias=NameNode(value=f"p{index}"),
+                name=field.name,
+                arguments=field.arguments,
+                directives=field.directives,
+                selection_set=field.selection_set,
+            )
+        )
+
+    return print_ast(
+        DocumentNode(
+            definitions=(
+                OperationDefinitionNode(
+                    operation=operation.operation,
+                    name=operation.name,
+                    variable_definitions=tuple(variable_definitions),
+                    directives=(),
+                    selection_set=SelectionSetNode(selections=tuple(selections)),
+                ),
+            )
+        )
+    )
+
+
+def batch_variables(batch: list[tuple[str, dict]]) -> dict:
+    """Variables of `batch_project_query` for pairs of full path and variables."""
+    variables = {}
+    for index, (project, args) in enumerate(batch):
+        for name, value in {"project": project, **args}.items():
+            variables[f"{name}_{index}"] = value
+    return variables
+
+
+def execute_batched(
+    client: Client, query: str, projects: dict[str, dict], batch_size: int = 10
+):
+    """Run a single project query for several projects with few requests.
+
+    `projects` maps full paths to the remaining variables of their query.
+    Yields the full path and the `project` part of the result for each of
+    them, just like executing `query` for every project on its own would.
+    Projects that don't exist or aren't accessible are skipped with a warning
+    instead of failing the whole batch.
+    """
+    for batch in batched(projects.items(), batch_size):
+        document = parse_query(batch_project_query(query, len(batch)))
+        result = execute(client, document, batch_variables(batch))
+        for index, (project, args) in enumerate(batch):
+            if result[f"p{index}"] is None:
+                logger.warning("Project %s not found or not accessible", project)
+                continue
+            yield project, result[f"p{index}"]
+
+
+def paginate_batched(
+    client: Client,
+    query: str,
+    node: str,
+    projects: dict[str, dict],
+    batch_size: int = 10,
+):
+    """Paginate a single project query for several projects.
+
+    Yields tuples of full path and node. The first page of all projects is
+    requested in batches, further pages are fetched separately and only for
+    projects that have them. All pages are streamed, see `stream_page`.
+    Projects that don't exist or aren't accessible are skipped with a warning.
+    """
+    for batch in batched(projects.items(), batch_size):
+        paths = {f"p{index}": project for index, (project, _) in enumerate(batch)}
+        page_infos = yield from map_page(
+            stream_page(
+                client,
+                batch_project_query(query, len(batch)),
+                list(paths),
+                node,
+                batch_variables(batch),
+            ),
+            lambda root, item: (paths[root], item),
+        )
+
+        for root, project in paths.items():
+            page_info = page_infos.get(root)
+            if page_info is None:
+                logger.warning("Project %s not found or not accessible", project)
+            elif page_info["hasNextPage"]:
+                for item in paginate(
+                    client,
+                    query,
+                    node,
+                    after=page_info["endCursor"],
+                    project=project,
+                    **projects[project],
+                ):
+                    yield project, item
+
+
+FTS_TABLES = {
+    "merge_requests": ["title", "description"],
+    "commits": ["message"],
+}
+
+
+def ensure_fts(db: Database) -> None:
+    # The FTS5 index is built once from the existing rows, afterwards triggers
+    # keep it in sync with every insert, update and replace.
+    for table, columns in FTS_TABLES.items():
+        if not db[table].exists() or db[table].detect_fts():
+            continue
+        # Placeholder tables (e.g. commits created by save_pipeline) don't have
+        # the text columns yet, so wait until real rows have been saved.
+        if not set(columns).issubset(db[table].columns_dict):
+            continue
+        db[table].enable_fts(columns, fts_version="FTS5", create_triggers=True)
+
+
+INDEXES = [
+    ("pipelines", ["project_id", "updated_at"]),
+    ("pipelines", ["project_id", "created_at"]),
+    ("merge_requests", ["target_project_id", "updated_at"]),
+    ("merge_requests", ["target_project_id", "created_at"]),
+    ("jobs", ["pipeline_id", "stage_name"]),
+    ("deployments", ["environment_id", "updated_at"]),
+]
+
+
+def get_meta(db: Database, key: str) -> str | None:
+    if not db["_meta"].exists():
+        return None
+    row = next(db["_meta"].rows_where("key = ?", [key]), None)
+    return row["value"] if row else None
+
+
+def set_meta(db: Database, key: str, value: str) -> None:
+    db["_meta"].upsert(
+        {"key": key, "value": value}, pk="key", columns={"key": str, "value": str}
+    )
+
+
+# Incremental syncs continue after the most recent row they have seen, per
+# project for pipelines and per environment for deployments. These times are
+# kept in the `_sync` table of the main database, so that they survive rows
+# being pruned or partitions being archived.
+SYNC_TIMES = {
+    "pipelines": ("project_id", "max(created_at, coalesce(updated_at, created_at))"),
+    "deployments": ("environment_id", "updated_at"),
+}
+
+
+def ensure_sync_table(db: Database) -> None:
+    if not db["_sync"].exists():
+        db["_sync"].create(
+            {"name": str, "key": int, "updated_at": str}, pk=("name", "key")
+        )
+
+
+def get_sync_time(db: Database, table: str, key: int | str) -> str | None:
+    if not db["_sync"].exists():
+        return None
+    row = next(db["_sync"].rows_where("name = ? AND key = ?", [table, key]), None)
+    return row["updated_at"] if row else None
+
+
+def set_sync_times(db: Database, table: str, times: dict[int | str, str]) -> None:
+    """Store the most recent times of `table` per key, older times are ignored."""
+    ensure_sync_table(db)
+    with db.conn:
+        db.conn.executemany(
+            """
+            INSERT INTO _sync (name, key, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (name, key) DO UPDATE
+            SET updated_at = max(updated_at, excluded.updated_at)
+            """,
+            [(table, key, time) for key, time in times.items() if time],
+        )
+
+
+def ensure_indexes(db: Database) -> dict[str, str]:
+    """Create missing indexes of INDEXES and analyze them.
+
+    Returns the names of the created indexes with their sqlite_stat1
+    statistics, e.g. "5000 10 1" for 5000 rows, about 10 rows per value of the
+    first column and a single row per value of both columns.
+    """
+    created = []
+    for table, columns in INDEXES:
+        if not db[table].exists():
+            continue
+        # Placeholder tables only have an id column until real rows arrive.
+        if not set(columns).issubset(db[table].columns_dict):
+            continue
+        name = f"idx_{table}_{'_'.join(columns)}"
+        if name in {index.name for index in db[table].indexes}:
+            continue
+        db[table].create_index(columns, index_name=name, if_not_exists=True)
+        created.append(name)
+
+    stats = {}
+    for name in created:
+        db.execute(f"ANALYZE [{name}]")
+        row = db.execute(
+            "SELECT stat FROM sqlite_stat1 WHERE idx = ?", [name]
+        ).fetchone()
+        # Indexes of empty tables don't get any statistics.
+        stats[name] = row[0] if row else None
+    return stats
+
+
+def ensure_db_shape(db: Database) -> dict[str, str]:
+    """Add indexes and full-text search, returns the created indexes.
+
+    See `ensure_indexes` for the returned statistics.
+    """
+    # Every step below only depends on the schema, so there is nothing to do
+    # if it hasn't changed since the last run.
+    if not db["_meta"].exists():
+        db["_meta"].create({"key": str, "value": str}, pk="key")
+    schema_version = str(db.execute("PRAGMA schema_version").fetchone()[0])
+    if get_meta(db, "schema_version") == schema_version:
+        return {}
+
+    db.index_foreign_keys()
+    ensure_fts(db)
+    created = ensure_indexes(db)
+
+    schema_version = str(db.execute("PRAGMA schema_version").fetchone()[0])
+    set_meta(db, "schema_version", schema_version)
+    return created
+
+
+PARTITIONED_TABLES = ["pipelines", "jobs", "deployments"]
+PARTITION_BY = ["month", "year", "project"]
+
+
+def get_partition(
+    db: Database,
+    partitions: dict[str, Database],
+    partition_by: str | None,
+    created_at: str,
+    project_id: int | str,
+    table: str | None = None,
+    id: int | str | None = None,
+) -> Database | None:
+    """Database that rows of partitioned tables are written to.
+
+    Partitions are separate SQLite files next to the main database, e.g.
+    `gitlab.2024-05.db` for `gitlab.db`. They are registered in the
+    `_partitions` table of the main database. Opened partitions are cached in
+    `partitions`. Rows of `table` that were saved before partitioning was
+    enabled stay in the main database, passing their `id` updates them there.
+
+    Returns None for partitions that have been archived (their file was
+    removed) or made read-only, rows that belong there are skipped.
+    """
+    if partition_by is None:
+        return db
+    if table is not None and (
+        "created_at" in db[table].columns_dict
+        and db.execute(
+            f"SELECT 1 FROM [{table}] WHERE id = ? AND created_at IS NOT NULL", [id]
+        ).fetchone()
+    ):
+        return db
+
+    name = {
+        "month": created_at[:7],
+        "year": created_at[:4],
+        "project": f"project-{project_id}",
+    }[partition_by]
+    if name not in partitions:
+        main = get_path(db)
+        path = main.with_name(f"{main.stem}.{name}{main.suffix}")
+        if name in get_partition_paths(db) and not path.exists():
+            logger.warning("Skipping rows of archived partition %s", path)
+            partitions[name] = None
+        elif path.exists() and not os.access(path, os.W_OK):
+            logger.warning("Skipping rows of read-only partition %s", path)
+            partitions[name] = None
+        else:
+            db["_partitions"].upsert(
+                {"name": name, "path": path.name},
+                pk="name",
+                columns={"name": str, "path": str},
+            )
+            partitions[name] = Database(path)
+    return partitions[name]
+
+
+def get_path(db: Database) -> pathlib.Path:
+    return pathlib.Path(db.execute("PRAGMA database_list").fetchone()[2])
+
+
+def get_partition_paths(db: Database) -> dict[str, pathlib.Path]:
+    if not db["_partitions"].exists():
+        return {}
+    directory = get_path(db).parent
+    return {row["name"]: directory / row["path"] for row in db["_partitions"].rows}
+
+
+def open_partitions(db: Database) -> dict[str, Database]:
+    """Open the partitions of `db` read-only, e.g. to look up watermarks.
+
+    Partitions whose files have been archived are skipped instead of being
+    recreated empty. Rows are written through `get_partition`.
+    """
+    return {
+        name: Database(sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True))
+        for name, path in get_partition_paths(db).items()
+        if path.exists()
+    }
+
+
+def attach_partitions(
+    db: Database, read_only: bool = False, names: list[str] | None = None
+) -> None:
+    """Make partitioned tables queryable under their usual names.
+
+    Attaches the partitions `names` (all by default) to `db` and creates a
+    TEMP view combining them with the rows in the main database for every
+    partitioned table. SQLite doesn't allow regular views to reference
+    attached databases, so this has to be done for every connection. SQLite
+    limits the number of attached databases, usually to 10, a ValueError is
+    raised if more partitions are requested.
+    """
+    paths = get_partition_paths(db)
+    if names is not None:
+        paths = {name: paths[name] for name in names}
+    # Archived partitions would be recreated as empty files.
+    paths = {name: path for name, path in paths.items() if path.exists()}
+    limit = db.conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(paths) > limit:
+        raise ValueError(
+            f"Can't attach {len(paths)} partitions, SQLite allows at most "
+            f"{limit} attached databases"
+        )
+
+    schemas = []
+    for index, path in enumerate(paths.values()):
+        schema = f"partition_{index}"
+        # URI filenames are only understood if the connection was opened with
+        # uri=True, which is required for read only access anyway.
+        db.execute(
+            f"ATTACH DATABASE ? AS [{schema}]",
+            [f"{path.resolve().as_uri()}?mode=ro" if read_only else str(path)],
+        )
+        schemas.append(schema)
+
+    if not schemas:
+        return
+
+    for table in PARTITIONED_TABLES:
+        columns = {}
+        for schema in ["main", *schemas]:
+            info = db.execute(f"PRAGMA [{schema}].table_info([{table}])").fetchall()
+            columns[schema] = [row[1] for row in info]
+        # Rows saved before partitioning was enabled stay in the main
+        # database. Placeholder rows, and tables with nothing but them, don't
+        # have a creation time.
+        if "created_at" not in columns["main"]:
+            del columns["main"]
+        all_columns = list(
+            dict.fromkeys(column for names in columns.values() for column in names)
+        )
+        selects = [
+            "SELECT "
+            + ", ".join(
+                f"[{column}]" if column in names else f"NULL AS [{column}]"
+                for column in all_columns
+            )
+            + f" FROM [{schema}].[{table}]"
+            + (" WHERE [created_at] IS NOT NULL" if schema == "main" else "")
+            for schema, names in columns.items()
+            if names
+        ]
+        if selects:
+            db.execute(f"DROP VIEW IF EXISTS temp.[{table}]")
+            db.execute(
+                f"CREATE TEMP VIEW [{table}] AS " + "\nUNION ALL\n".join(selects)
+            )
+
+
+RETENTION_DAYS = {"pipelines": 90, "jobs": 90}
+
+# Daily aggregates that rows are folded into before they are pruned. Text
+# columns are coalesced because NULLs never conflict in a primary key.
+SUMMARIES = {
+    "pipelines": (
+        "pipelines_daily",
+        {
+            "project_id": "project_id",
+            "day": "substr(created_at, 1, 10)",
+            "ref": "coalesce(ref, '')",
+            "status": "coalesce(status, '')",
+        },
+        {"count": "count(*)", "duration": "sum(duration)"},
+    ),
+    "jobs": (
+        "jobs_daily",
+        {
+            "project_id": "project_id",
+            "day": "substr(created_at, 1, 10)",
+            "stage_name": "coalesce(stage_name, '')",
+            "name": "coalesce(name, '')",
+            "status": "coalesce(status, '')",
+        },
+        {
+            "count": "count(*)",
+            "duration": "sum(duration)",
+            "queued_duration": "sum(queued_duration)",
+        },
+    ),
+    "deployments": (
+        "deployments_daily",
+        {
+            "project_id": "project_id",
+            "environment_id": "environment_id",
+            "day": "substr(created_at, 1, 10)",
+            "status": "coalesce(status, '')",
+        },
+        {"count": "count(*)"},
+    ),
+}
+
+
+def prune_table(
+    db: Database,
+    table: str,
+    days: int,
+    summarize: bool = False,
+    batch_size: int = 1000,
+    schema: str = "main",
+) -> int:
+    """Delete rows created more than `days` ago, returns the number of rows.
+
+    Rows are deleted in batches of `batch_size`, each in its own transaction,
+    so that other writers are never blocked for long. With `summarize` each
+    batch is added to the summary table of `table` first, except for rows
+    older than the cutoff of an earlier run. `schema` allows to prune a
+    partition attached to `db`, summaries and sync times always go to main.
+    """
+    # Also skips placeholder tables which only have an id column.
+    columns = [row[1] for row in db.execute(f"PRAGMA [{schema}].table_info([{table}])")]
+    if "created_at" not in columns:
+        return 0
+
+    cutoff = (
+        datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+    ).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    if table in SYNC_TIMES:
+        # Keep the sync times of the deleted rows, otherwise the next sync
+        # would fetch them again.
+        ensure_sync_table(db)
+        key, time = SYNC_TIMES[table]
+        sync_sql = f"""
+            INSERT INTO main._sync (name, key, updated_at)
+            SELECT '{table}', [{key}], max({time})
+            FROM [{schema}].[{table}]
+            WHERE rowid IN (SELECT value FROM json_each(?)) AND [{key}] IS NOT NULL
+            GROUP BY [{key}]
+            ON CONFLICT (name, key) DO UPDATE
+            SET updated_at = max(updated_at, excluded.updated_at)
+        """
+
+    if summarize:
+        # Rows created before an earlier cutoff have been summarized already,
+        # e.g. if they were fetched again after being pruned.
+        db.execute(
+            f"CREATE TABLE IF NOT EXISTS [{schema}].[_meta]"
+            " ([key] TEXT PRIMARY KEY, [value] TEXT)"
+        )
+        row = db.execute(
+            f"SELECT value FROM [{schema}].[_meta] WHERE key = ?",
+            [f"summarized_through_{table}"],
+        ).fetchone()
+        summarized = row[0] if row else None
+        summary, group, values = SUMMARIES[table]
+        if not db[summary].exists():
+            db[summary].create(
+                {
+                    **{
+                        column: int if column.endswith("_id") else str
+                        for column in group
+                    },
+                    **{column: int for column in values},
+                },
+                pk=list(group),
+            )
+        summarize_sql = f"""
+            INSERT INTO main.[{summary}] ({", ".join(f"[{c}]" for c in [*group, *values])})
+            SELECT {", ".join([*group.values(), *values.values()])}
+            FROM [{schema}].[{table}]
+            WHERE rowid IN (SELECT value FROM json_each(:rowids))
+            AND created_at >= :summarized
+            GROUP BY {", ".join(group.values())}
+            ON CONFLICT ({", ".join(f"[{c}]" for c in group)}) DO UPDATE SET
+            {", ".join(f"[{c}] = coalesce([{c}], 0) + coalesce(excluded.[{c}], 0)" for c in values)}
+        """
+
+    deleted = 0
+    while True:
+        with db.conn:
+            rowids = [
+                row[0]
+                for row in db.execute(
+                    f"SELECT rowid FROM [{schema}].[{table}] WHERE created_at < ? LIMIT ?",
+                    [cutoff, batch_size],
+                )
+            ]
+            if not rowids:
+                break
+            if table in SYNC_TIMES:
+                db.execute(sync_sql, [json.dumps(rowids)])
+            if summarize:
+                db.execute(
+                    summarize_sql,
+                    {"rowids": json.dumps(rowids), "summarized": summarized or ""},
+                )
+            db.execute(
+                f"DELETE FROM [{schema}].[{table}] WHERE rowid IN (SELECT value FROM json_each(?))",
+                [json.dumps(rowids)],
+            )
+        deleted += len(rowids)
+
+    if summarize and (summarized is None or summarized < cutoff):
+        with db.conn:
+            db.execute(
+                f"INSERT OR REPLACE INTO [{schema}].[_meta] (key, value) VALUES (?, ?)",
+                [f"summarized_through_{table}", cutoff],
+            )
+    return deleted
+
+
+# Tables that get rows with only an id to satisfy foreign keys, mapped to a
+# column only actual rows have and the columns referring to them.
+PLACEHOLDERS = {
+    "pipelines": ("created_at", [("merge_requests", "head_pipeline_id")]),
+    "jobs": ("created_at", [("deployments", "job_id")]),
+    "environments": (
+        "created_at",
+        [("deployments", "environment_id"), ("deployments_daily", "environment_id")],
+    ),
+    "projects": (
+        "full_path",
+        [
+            ("merge_requests", "target_project_id"),
+            ("environments", "project_id"),
+            ("pipelines", "project_id"),
+            ("jobs", "project_id"),
+            ("deployments", "project_id"),
+            ("commits", "project_id"),
+            ("pipelines_daily", "project_id"),
+            ("jobs_daily", "project_id"),
+            ("deployments_daily", "project_id"),
+        ],
+    ),
+}
+
+
+def prune_placeholders(db: Database, batch_size: int = 1000) -> dict[str, int]:
+    """Delete placeholder rows that nothing refers to anymore.
+
+    save_merge_request, save_deployment and save_environment create pipelines,
+    jobs, environments and projects with only an id to satisfy their foreign
+    keys. Once the referencing rows are pruned and the actual row was never
+    fetched, these are left behind. If the database is partitioned, tables
+    referenced from PARTITIONED_TABLES are skipped.
+    """
+    partitioned = get_meta(db, "partition_by") is not None
+    deleted = {}
+    for table, (column, references) in PLACEHOLDERS.items():
+        if not db[table].exists() or column not in db[table].columns_dict:
+            continue
+        if partitioned and any(other in PARTITIONED_TABLES for other, _ in references):
+            # The referencing rows might live in partitions.
+            continue
+        unreferenced = "".join(
+            f" AND id NOT IN (SELECT CAST([{key}] AS INTEGER) FROM [{other}] WHERE [{key}] IS NOT NULL)"
+            for other, key in references
+            if db[other].exists() and key in db[other].columns_dict
+        )
+
+        deleted[table] = 0
         while True:
-            try:
-                result = client.execute(
-                    query, variable_values={**args, "after": after_cursor}
+            with db.conn:
+                cursor = db.execute(
+                    f"""
+                    DELETE FROM [{table}] WHERE rowid IN (
+                        SELECT rowid FROM [{table}]
+                        WHERE [{column}] IS NULL{unreferenced}
+                        LIMIT ?
+                    )""",
+                    [batch_size],
                 )
+            if cursor.rowcount <= 0:
                 break
-            except Exception as e:
-                attempt += 1
-                if attempt > 4:
-                    raise
-                continue
+            deleted[table] += cursor.rowcount
+    return deleted
+
 
-        yield from get(result)[node]["nodes"]
+def reclaim_space(db: Database, schema: str = "main", pages: int = 1000) -> bool:
+    """Release free pages in steps of `pages`, if incremental vacuum is enabled.
 
-        has_next_page = get(result)[node]["pageInfo"]["hasNextPage"]
-        after_cursor = get(result)[node]["pageInfo"]["endCursor"]
+    Returns False if the database doesn't use auto_vacuum=INCREMENTAL.
+    """
+    if db.execute(f"PRAGMA [{schema}].auto_vacuum").fetchone()[0] != 2:
+        return False
+    while db.execute(f"PRAGMA [{schema}].freelist_count").fetchone()[0]:
+        db.execute(f"PRAGMA [{schema}].incremental_vacuum({int(pages)})").fetchall()
+    return True
 
 
-def ensure_db_shape(db: Database):
-    db.index_foreign_keys()
+def enable_incremental_vacuum(db: Database) -> None:
+    # Changing auto_vacuum of an existing database only takes effect after a
+    # full VACUUM, which rewrites the whole file once.
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute("VACUUM")
@@ -0,0 +1,169 @@
+import json
+import types
+
+import pytest
+import requests
+import urllib3
+from gql.transport.exceptions import TransportQueryError
+
+from gitlab_to_sqlite import utils
+from gitlab_to_sqlite.tokens import TokenPool
+
+QUERY = """
+query pipelines ($project: ID!, $after: String) {
+  project(fullPath: $project) {
+    pipelines(first: 2, after: $after) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        id
+      }
+    }
+  }
+}
+"""
+
+
+def page(ids, next_cursor=None):
+    return {
+        "pipelines": {
+            "pageInfo": {"hasNextPage": bool(next_cursor), "endCursor": next_cursor},
+            "nodes": [{"id": id} for id in ids],
+        }
+    }
+
+
+class Raw:
+    """Response body read in small chunks, optionally breaking off."""
+
+    def __init__(self, body, break_at=None):
+        self.body = body
+        self.break_at = break_at
+        self.position = 0
+
+    def read(self, size=-1):
+        if self.break_at is not None and self.position >= self.break_at:
+            raise urllib3.exceptions.ProtocolError("Connection broken")
+        end = self.position + (16 if size < 0 else min(size, 16))
+        if self.break_at is not None:
+            end = min(end, self.break_at)
+        chunk = self.body[self.position : end]
+        self.position += len(chunk)
+        return chunk
+
+
+class Response:
+    def __init__(self, body, break_at=None):
+        self.status_code = 200
+        self.headers = {}
+        self.raw = Raw(json.dumps(body).encode(), break_at)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Answers requests with the next canned response for their variables."""
+    responses = {}
+    requested = []
+
+    def post(url, json, **kwargs):
+        key = tuple(sorted(json["variables"].items()))
+        requested.append(dict(json["variables"]))
+        return responses[key].pop(0)
+
+    monkeypatch.setattr(requests, "post", post)
+
+    def respond(variables, *canned):
+        responses.setdefault(tuple(sorted(variables.items())), []).extend(canned)
+
+    respond.requested = requested
+    return respond
+
+
+@pytest.fixture
+def client():
+    return types.SimpleNamespace(
+        transport=types.SimpleNamespace(url="https://gitlab.test", headers=None),
+        execute_timeout=20,
+        token_pool=TokenPool(["token"]),
+    )
+
+
+def test_batched_first_pages(server, client, caplog):
+    server(
+        {"project_0": "a", "project_1": "missing", "project_2": "b"},
+        Response({"data": {"p0": page([1, 2], "c1"), "p1": None, "p2": page([3])}}),
+    )
+    server(
+        {"project": "a", "after": "c1"},
+        Response({"data": {"project": page([4])}}),
+    )
+
+    nodes = utils.paginate_batched(
+        client, QUERY, "pipelines", {"a": {}, "missing": {}, "b": {}}
+    )
+
+    assert [(project, node["id"]) for project, node in nodes] == [
+        ("a", 1),
+        ("a", 2),
+        ("b", 3),
+        ("a", 4),
+    ]
+    assert "Project missing not found or not accessible" in caplog.text
+
+
+def test_unbatched(server, client):
+    server({"project_0": "a"}, Response({"data": {"p0": page([1], "c1")}}))
+    server({"project": "a", "after": "c1"}, Response({"data": {"project": page([2])}}))
+
+    nodes = utils.paginate_batched(client, QUERY, "pipelines", {"a": {}}, 1)
+
+    assert [node["id"] for _, node in nodes] == [1, 2]
+
+
+def test_null_project(server, client):
+    server({"project": "missing", "after": None}, Response({"data": {"project": None}}))
+
+    with pytest.raises(ValueError, match="missing not found"):
+        list(utils.paginate(client, QUERY, "pipelines", project="missing"))
+
+
+def test_errors(server, client):
+    server(
+        {"project_0": "a"},
+        Response({"errors": [{"message": "Query too complex"}], "data": None}),
+    )
+
+    with pytest.raises(TransportQueryError, match="Query too complex"):
+        list(utils.paginate_batched(client, QUERY, "pipelines", {"a": {}}))
+
+
+def test_broken_response_before_first_node_is_retried(server, client):
+    body = {"data": {"p0": page([1, 2])}}
+    server({"project_0": "a"}, Response(body, break_at=10), Response(body))
+
+    nodes = utils.paginate_batched(client, QUERY, "pipelines", {"a": {}})
+
+    assert [node["id"] for _, node in nodes] == [1, 2]
+    assert len(server.requested) == 2
+
+
+def test_broken_response_after_first_node(server, client):
+    body = {"data": {"p0": page([1, 2])}}
+    server({"project_0": "a"}, Response(body, break_at=len(json.dumps(body)) - 10))
+
+    nodes = utils.paginate_batched(client, QUERY, "pipelines", {"a": {}})
+
+    assert next(nodes)[1]["id"] == 1
+    with pytest.raises(RuntimeError, match="broke off after 1 nodes"):
+        list(nodes)
@@ -0,0 +1,40 @@
+import json
+import pathlib
+import subprocess
+import sys
+
+ROOT = pathlib.Path(__file__).parent.parent
+
+# Only loaded once a command talks to GitLab, see gitlab_to_sqlite.utils.
+HEAVY_MODULES = ["gitlab", "gql", "graphql", "aiohttp", "requests", "ijson"]
+
+
+def import_cli() -> dict:
+    code = f"""
+import json, sys, time
+start = time.perf_counter()
+import gitlab_to_sqlite.cli
+duration = time.perf_counter() - start
+print(json.dumps({{
+    "duration": duration,
+    "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules],
+}}))
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output)
+
+
+def test_cli_import_does_not_load_heavy_modules():
+    assert import_cli()["loaded"] == []
+
+
+def test_cli_import_time():
+    # Generous budget, eagerly importing gql and python-gitlab takes several
+    # times as long.
+    assert min(import_cli()["duration"] for _ in range(3)) < 0.5